@@ -27,15 +27,34 @@
 from experiments.checkpoint_utils import CheckpointUtils
 from error_handling.console_logger import ConsoleLogger
 
-import yaml
 import numpy as np
 import os
+import matplotlib
 import matplotlib.pyplot as plt
-from scipy.signal import savgol_filter
+from scipy.ndimage import correlate1d
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+
+
+# A figure to render, saved at the path fig_key, with one subplot per PlotAxes of axes
+PlotTask = namedtuple('PlotTask', ['fig_key', 'figsize', 'axes'])
+# The curves of a subplot, of shape (n_curves, n_epochs, steps_per_epoch), with a color and
+# a label per curve and the options of LossesPlotter._configure_ax
+PlotAxes = namedtuple('PlotAxes', ['curves', 'colors', 'labels', 'options'])
 
 
 class LossesPlotter(object):
 
+    _maximum_smoothing_window_length = 201
+    _smoothing_polyorder = 7
+    # Savitzky-Golay projection matrices keyed by (window_length, polyorder)
+    _savgol_projections = dict()
+    # Colormap objects keyed by name
+    _colormaps = dict()
+    # Figures reused between renderings of the same process, keyed by size
+    _figures = dict()
+
     def __init__(self, colormap_name='nipy_spectral'):
         self._colormap_name = colormap_name
 
@@ -50,231 +69,241 @@ class LossesPlotter(object):
             try:
                 train_res_losses, train_res_perplexities, latest_epoch = \
                     CheckpointUtils.retreive_losses_values(experiments_path, experiment)
-                all_train_losses.append(train_res_losses)
-                all_train_perplexities.append(train_res_perplexities)
-                all_results_paths.append(experiment.results_path)
-                all_experiments_names.append(experiment.name)
-                all_latest_epochs.append(latest_epoch)
             except:
                 ConsoleLogger.error("Failed to retreive losses of experiment '{}'".format(experiment.name))
+                continue
 
-        n_final_losses_colors = len(all_train_losses)
-        final_losses_colors = self._get_colors_from_cmap(self._colormap_name, n_final_losses_colors)
+            # The curves are reshaped by epoch, so each epoch must have the same number of steps
+            steps_per_epoch = len(train_res_perplexities) // latest_epoch
+            for curve in list(train_res_losses.values()) + [train_res_perplexities]:
+                if len(curve) != latest_epoch * steps_per_epoch:
+                    raise ValueError("Curve of length {} of experiment '{}' cannot be split into {} epochs of {} steps".format(
+                        len(curve), experiment.name, latest_epoch, steps_per_epoch))
 
-        # for each experiment: final loss + perplexity
-        self._plot_loss_and_perplexity_figures(
-            all_results_paths,
-            all_experiments_names,
-            all_train_losses,
-            all_train_perplexities,
-            all_latest_epochs,
-            n_final_losses_colors,
-            final_losses_colors
-        )
-
-        # merged experiment: merged final losses + merged perplexities
-        self._plot_merged_losses_and_perplexities_figure(
-            all_results_paths,
-            all_experiments_names,
-            all_train_losses,
-            all_train_perplexities,
-            all_latest_epochs,
-            n_final_losses_colors,
-            final_losses_colors
-        )
+            all_train_losses.append(train_res_losses)
+            all_train_perplexities.append(train_res_perplexities)
+            all_results_paths.append(experiment.results_path)
+            all_experiments_names.append(experiment.name)
+            all_latest_epochs.append(latest_epoch)
 
-        # for each experiment: all possible losses
-        self._plot_merged_all_losses_figures(
-            all_results_paths,
-            all_experiments_names,
-            all_train_losses,
-            all_train_perplexities,
-            all_latest_epochs
-        )
+        # The merged figures require the same number of epochs in all experiments
+        merge_experiments = all(latest_epoch == all_latest_epochs[0] for latest_epoch in all_latest_epochs)
 
-        # merged losses of a single type in all experiments
-        self._plot_merged_all_losses_type(
+        plot_plan = self._build_plot_plan(
             all_results_paths,
             all_experiments_names,
             all_train_losses,
             all_train_perplexities,
-            all_latest_epochs
+            all_latest_epochs,
+            merge_experiments
         )
+        self._execute_plot_plan(plot_plan)
 
-    def _plot_loss_and_perplexity_figures(self, all_results_paths, all_experiments_names, all_train_losses,
-        all_train_perplexities, all_latest_epochs, n_colors, colors):
-        
-        for i in range(len(all_experiments_names)):
-            results_path = all_results_paths[i]
-            experiment_name = all_experiments_names[i]
-            output_plot_path = results_path + os.sep + experiment_name + '_loss-and-perplexity.png'
-
-            train_loss_smooth = self._smooth_curve(all_train_losses[i]['loss'])
-            train_perplexity_smooth = self._smooth_curve(all_train_perplexities[i])
-
-            latest_epoch = all_latest_epochs[i]
+        if not merge_experiments:
+            raise ValueError('All experiments must have the same number of epochs to merge them')
 
-            train_loss_smooth = np.asarray(train_loss_smooth)
-            train_perplexity_smooth = np.asarray(train_perplexity_smooth)
-            train_loss_smooth = np.reshape(train_loss_smooth, (latest_epoch, train_loss_smooth.shape[0] // latest_epoch))
-            train_perplexity_smooth = np.reshape(train_perplexity_smooth, (latest_epoch, train_perplexity_smooth.shape[0] // latest_epoch))
+    def _build_plot_plan(self, all_results_paths, all_experiments_names, all_train_losses,
+        all_train_perplexities, all_latest_epochs, merge_experiments, colormap_name='tab20'):
+        """
+        Smooth the curves of each experiment and list the figures to render as PlotTask,
+        in a single pass over the experiments.
+        """
 
-            fig = plt.figure(figsize=(16, 8))
+        plot_plan = list()
 
-            ax = fig.add_subplot(1, 2, 1)
-            ax = self._plot_fill_between(ax, colors[i], train_loss_smooth, all_experiments_names[i])
-            ax = self._configure_ax(ax, title='Smoothed loss', xlabel='Epochs', ylabel='Loss',
-                legend=False)
-
-            ax = fig.add_subplot(1, 2, 2)
-            ax = self._plot_fill_between(ax, colors[i], train_perplexity_smooth, all_experiments_names[i])
-            ax = self._configure_ax(ax, title='Smoothed average codebook usage',
-                xlabel='Epochs', ylabel='Perplexity', legend=False)
-
-            fig.savefig(output_plot_path)
-            plt.close(fig)
-
-            ConsoleLogger.success("Saved figure at path '{}'".format(output_plot_path))
-
-    def _plot_merged_losses_and_perplexities_figure(self, all_results_paths, all_experiments_names, all_train_losses,
-        all_train_perplexities, all_latest_epochs, n_colors, colors):
-
-        latest_epoch = all_latest_epochs[0]
-        for i in range(1, len(all_latest_epochs)):
-            if all_latest_epochs[i] != latest_epoch:
-                raise ValueError('All experiments must have the same number of epochs to merge them')
+        n_final_losses_colors = len(all_train_losses)
+        final_losses_colors = self._get_colors_from_cmap(self._colormap_name, n_final_losses_colors)
+        # The colors only depend on their number, which is usually the same for all the figures
+        colors_by_n_colors = dict()
 
-        results_path = all_results_paths[0]
-        experiment_name = 'merged-loss-and-perplexity'
-        output_plot_path = results_path + os.sep + experiment_name + '.png'
-        
         all_train_loss_smooth = list()
         all_train_perplexity_smooth = list()
-        for i in range(len(all_train_perplexities)):
-            train_loss_smooth = self._smooth_curve(all_train_losses[i]['loss'])
-            train_perplexity_smooth = self._smooth_curve(all_train_perplexities[i])
-            all_train_loss_smooth.append(train_loss_smooth)
-            all_train_perplexity_smooth.append(train_perplexity_smooth)
-
-        all_train_loss_smooth = np.asarray(all_train_loss_smooth)
-        all_train_perplexity_smooth = np.asarray(all_train_perplexity_smooth)
-        all_train_loss_smooth = np.reshape(all_train_loss_smooth, (n_colors, latest_epoch, all_train_loss_smooth.shape[1] // latest_epoch))
-        all_train_perplexity_smooth = np.reshape(all_train_perplexity_smooth, (n_colors, latest_epoch, all_train_perplexity_smooth.shape[1] // latest_epoch))
-
-        fig = plt.figure(figsize=(16, 8))
-
-        ax = fig.add_subplot(1, 2, 1)
-        for i in range(len(all_train_loss_smooth)):
-            ax = self._plot_fill_between(ax, colors[i], all_train_loss_smooth[i], all_experiments_names[i])
-        ax = self._configure_ax(ax, title='Smoothed loss', xlabel='Epochs', ylabel='Loss',
-            legend=True)
-
-        ax = fig.add_subplot(1, 2, 2)
-        for i in range(len(all_train_perplexity_smooth)):
-            ax = self._plot_fill_between(ax, colors[i], all_train_perplexity_smooth[i], all_experiments_names[i])
-        ax = self._configure_ax(ax, title='Smoothed average codebook usage', xlabel='Epochs',
-            ylabel='Perplexity', legend=True)
-
-        fig.savefig(output_plot_path)
-        plt.close(fig)
+        all_train_losses_smooth_by_type = defaultdict(list)
 
-        ConsoleLogger.success("Saved figure at path '{}'".format(output_plot_path))
-
-    def _plot_merged_all_losses_figures(self, all_results_paths, all_experiments_names, all_train_losses,
-        all_train_perplexities, all_latest_epochs, colormap_name='tab20'):
-
-        latest_epoch = all_latest_epochs[0]
-        for i in range(1, len(all_latest_epochs)):
-            if all_latest_epochs[i] != latest_epoch:
-                raise ValueError('All experiments must have the same number of epochs to merge them')
-
-        results_path = all_results_paths[0]
-
-        all_train_losses_smooth = list()
         for i in range(len(all_train_losses)):
-            train_losses_smooth = list()
-            train_losses_names = list()
-            for key in all_train_losses[i].keys():
-                train_loss_smooth = self._smooth_curve(all_train_losses[i][key])
-                train_losses_smooth.append(train_loss_smooth)
-                train_losses_names.append(key)
-            all_train_losses_smooth.append((train_losses_smooth, train_losses_names))
-
-        for i in range(len(all_train_losses_smooth)):
-            n_colors = len(all_train_losses[i])
-            colors = self._get_colors_from_cmap(colormap_name, n_colors)
-
-            (train_losses_smooth, train_losses_names) = all_train_losses_smooth[i]
-            all_train_loss_smooth = np.asarray(train_losses_smooth)
-            all_train_loss_smooth = np.reshape(all_train_loss_smooth, (n_colors, latest_epoch, all_train_loss_smooth.shape[1] // latest_epoch))
-
-            fig, ax = plt.subplots(figsize=(8, 8))
-
-            for j in range(len(all_train_loss_smooth)):
-                ax = self._plot_fill_between(ax, colors[j], all_train_loss_smooth[j], train_losses_names[j])
+            results_path = all_results_paths[i]
             experiment_name = all_experiments_names[i]
-            ax = self._configure_ax(ax, title='Smoothed losses of ' + experiment_name, xlabel='Epochs', ylabel='Loss', legend=True)
-            output_plot_path = results_path + os.sep + experiment_name + '_merged-losses.png'
-
-            fig.savefig(output_plot_path)
-            plt.close(fig)
 
-            ConsoleLogger.success("Saved figure at path '{}'".format(output_plot_path))
+            # Smooth all the curves of the experiment at once and split them by epoch
+            losses_names = list(all_train_losses[i].keys())
+            curves_smooth = self._smooth_curves_batch(
+                self._stack_curves([all_train_losses[i][loss_name] for loss_name in losses_names] + [all_train_perplexities[i]])
+            )
+            # A contiguous float32 buffer is split by epoch as a view, without a hidden copy.
+            # Only the storage is single precision, the per-epoch statistics accumulate in double
+            curves_smooth = np.ascontiguousarray(curves_smooth, dtype=np.float32).reshape(
+                len(curves_smooth), all_latest_epochs[i], -1)
+            train_losses_smooth = curves_smooth[:-1]
+            train_perplexity_smooth = curves_smooth[-1]
+            train_loss_smooth = train_losses_smooth[losses_names.index('loss')]
+
+            # for each experiment: final loss + perplexity
+            plot_plan.append(PlotTask(
+                fig_key=os.path.join(results_path, '{}_loss-and-perplexity.png'.format(experiment_name)),
+                figsize=(16, 8),
+                axes=[
+                    PlotAxes(curves=train_loss_smooth[np.newaxis], colors=final_losses_colors[i:i+1], labels=[experiment_name],
+                        options=dict(title='Smoothed loss', xlabel='Epochs', ylabel='Loss', legend=False)),
+                    PlotAxes(curves=train_perplexity_smooth[np.newaxis], colors=final_losses_colors[i:i+1], labels=[experiment_name],
+                        options=dict(title='Smoothed average codebook usage', xlabel='Epochs', ylabel='Perplexity', legend=False))
+                ]
+            ))
+
+            if not merge_experiments:
+                continue
+
+            # for each experiment: all possible losses
+            n_colors = len(losses_names)
+            if n_colors not in colors_by_n_colors:
+                colors_by_n_colors[n_colors] = self._get_colors_from_cmap(colormap_name, n_colors)
+            plot_plan.append(PlotTask(
+                fig_key=os.path.join(all_results_paths[0], '{}_merged-losses.png'.format(experiment_name)),
+                figsize=(8, 8),
+                axes=[
+                    PlotAxes(curves=train_losses_smooth, colors=colors_by_n_colors[n_colors], labels=losses_names,
+                        options=dict(title='Smoothed losses of ' + experiment_name, xlabel='Epochs', ylabel='Loss', legend=True))
+                ]
+            ))
 
-    def _plot_merged_all_losses_type(self, all_results_paths, all_experiments_names, all_train_losses,
-        all_train_perplexities, all_latest_epochs, colormap_name='tab20'):
+            all_train_loss_smooth.append(train_loss_smooth)
+            all_train_perplexity_smooth.append(train_perplexity_smooth)
+            for loss_name, loss_smooth in zip(losses_names, train_losses_smooth):
+                if loss_name != 'loss':
+                    all_train_losses_smooth_by_type[loss_name].append(loss_smooth)
 
-        latest_epoch = all_latest_epochs[0]
-        for i in range(1, len(all_latest_epochs)):
-            if all_latest_epochs[i] != latest_epoch:
-                raise ValueError('All experiments must have the same number of epochs to merge them')
+        if not merge_experiments or len(all_train_losses) == 0:
+            return plot_plan
 
         results_path = all_results_paths[0]
 
-        all_train_losses_smooth = dict()
-        for i in range(len(all_train_losses)):
-            for loss_name in all_train_losses[i].keys():
-                if loss_name == 'loss':
-                    continue
-                if loss_name not in all_train_losses_smooth:
-                    all_train_losses_smooth[loss_name] = list()
-                all_train_losses_smooth[loss_name].append(self._smooth_curve(all_train_losses[i][loss_name]))
-
-        for loss_name in all_train_losses_smooth.keys():
-            n_colors = len(all_train_losses_smooth[loss_name])
-            colors = self._get_colors_from_cmap(colormap_name, n_colors)
-
-            train_losses_smooth = all_train_losses_smooth[loss_name]
-            all_train_loss_smooth = np.asarray(train_losses_smooth)
-            all_train_loss_smooth = np.reshape(all_train_loss_smooth, (n_colors, latest_epoch, all_train_loss_smooth.shape[1] // latest_epoch))
-
-            fig, ax = plt.subplots(figsize=(8, 8))
-
-            for j in range(len(all_train_loss_smooth)):
-                ax = self._plot_fill_between(ax, colors[j], all_train_loss_smooth[j], all_experiments_names[j])
-            ax = self._configure_ax(ax, title='Smoothed ' + loss_name.replace('_', ' '), xlabel='Epochs', ylabel='Loss', legend=True)
-            output_plot_path = results_path + os.sep + loss_name + '.png'
-
-            fig.savefig(output_plot_path)
-            plt.close(fig)
-
-            ConsoleLogger.success("Saved figure at path '{}'".format(output_plot_path))
-
-    def _smooth_curve(self, curve_values):
-        maximum_window_length = 201
-        smoothed_curve_len = len(curve_values)
-        smoothed_curve_len = smoothed_curve_len if smoothed_curve_len % 2 == 1 else smoothed_curve_len - 1
-        polyorder = 7
-
-        smoothed_curve = savgol_filter(
-            curve_values,
-            maximum_window_length if smoothed_curve_len > maximum_window_length else smoothed_curve_len,
-            polyorder
-        )
+        # merged experiment: merged final losses + merged perplexities
+        plot_plan.append(PlotTask(
+            fig_key=os.path.join(results_path, 'merged-loss-and-perplexity.png'),
+            figsize=(16, 8),
+            axes=[
+                PlotAxes(curves=self._stack_curves(all_train_loss_smooth), colors=final_losses_colors, labels=all_experiments_names,
+                    options=dict(title='Smoothed loss', xlabel='Epochs', ylabel='Loss', legend=True)),
+                PlotAxes(curves=self._stack_curves(all_train_perplexity_smooth), colors=final_losses_colors, labels=all_experiments_names,
+                    options=dict(title='Smoothed average codebook usage', xlabel='Epochs', ylabel='Perplexity', legend=True))
+            ]
+        ))
 
-        return smoothed_curve
+        # merged losses of a single type in all experiments
+        for loss_name in all_train_losses_smooth_by_type.keys():
+            n_colors = len(all_train_losses_smooth_by_type[loss_name])
+            if n_colors not in colors_by_n_colors:
+                colors_by_n_colors[n_colors] = self._get_colors_from_cmap(colormap_name, n_colors)
+            plot_plan.append(PlotTask(
+                fig_key=os.path.join(results_path, loss_name + '.png'),
+                figsize=(8, 8),
+                axes=[
+                    PlotAxes(curves=self._stack_curves(all_train_losses_smooth_by_type[loss_name]),
+                        colors=colors_by_n_colors[n_colors], labels=all_experiments_names,
+                        options=dict(title='Smoothed ' + loss_name.replace('_', ' '), xlabel='Epochs', ylabel='Loss', legend=True))
+                ]
+            ))
+
+        return plot_plan
+
+    def _execute_plot_plan(self, plot_plan):
+        if len(plot_plan) == 0:
+            return
+
+        # The figures are independent, so render them in parallel
+        with ProcessPoolExecutor(max_workers=min(cpu_count(), len(plot_plan)),
+            initializer=LossesPlotter._initialize_plotting_worker) as executor:
+            futures = [executor.submit(LossesPlotter._save_figure, plot_task) for plot_task in plot_plan]
+            for future in futures:
+                ConsoleLogger.success("Saved figure at path '{}'".format(future.result()))
+
+    @staticmethod
+    def _initialize_plotting_worker():
+        # The worker processes only save figures to files, so skip any interactive
+        # backend initialization. This is set once per worker, never in the caller process
+        matplotlib.use('Agg')
+
+    @staticmethod
+    def _save_figure(plot_task):
+        """
+        Render the figure described by plot_task, with one subplot per PlotAxes, and
+        save it at the path given by its fig_key.
+        Static so that it can be pickled and run in a worker process.
+        """
+
+        if plot_task.figsize not in LossesPlotter._figures:
+            LossesPlotter._figures[plot_task.figsize] = plt.figure(figsize=plot_task.figsize)
+        fig = LossesPlotter._figures[plot_task.figsize]
+        fig.clear()
+
+        for k, plot_axes in enumerate(plot_task.axes):
+            ax = fig.add_subplot(1, len(plot_task.axes), k + 1)
+            t = np.arange(plot_axes.curves.shape[1])
+            for j in range(len(plot_axes.curves)):
+                ax = LossesPlotter._plot_fill_between(ax, plot_axes.colors[j], plot_axes.curves[j], plot_axes.labels[j], t=t)
+            ax = LossesPlotter._configure_ax(ax, **plot_axes.options)
+
+        fig.savefig(plot_task.fig_key, dpi=100)
+
+        return plot_task.fig_key
+
+    def _stack_curves(self, curves):
+        # Copy the curves row by row into a single preallocated float32 buffer
+        stacked_curves = np.empty((len(curves),) + np.shape(curves[0]), dtype=np.float32)
+        for j, curve in enumerate(curves):
+            stacked_curves[j] = curve
+        return stacked_curves
+
+    def _smooth_curves_batch(self, curves_values):
+        # Smooth a (n_curves, curve_len) array of curves in a single filter call
+        return self._savgol_filter(
+            curves_values,
+            self._get_smoothing_window_length(curves_values.shape[1]),
+            self._smoothing_polyorder
+        )
 
-    def _configure_ax(self, ax, title=None, xlabel=None, ylabel=None,
+    def _get_smoothing_window_length(self, curve_len):
+        # The window length of the filter must be odd and can't exceed the curve length
+        smoothed_curve_len = curve_len if curve_len % 2 == 1 else curve_len - 1
+        return min(self._maximum_smoothing_window_length, smoothed_curve_len)
+
+    @staticmethod
+    def _get_savgol_projection(window_length, polyorder):
+        """
+        Least squares projection of a window onto the polynomials of degree polyorder.
+        Row k of the matrix gives the fitted value at position k of the window, so the
+        middle row holds the usual Savitzky-Golay coefficients and the other rows the
+        polynomial fit of the edges (equivalent to the 'interp' mode of scipy's savgol_filter).
+        """
+
+        key = (window_length, polyorder)
+        if key not in LossesPlotter._savgol_projections:
+            if polyorder >= window_length:
+                raise ValueError('polyorder must be less than window_length')
+            # The projection doesn't depend on the sample positions, so use well-conditioned ones
+            positions = np.linspace(-1, 1, window_length)
+            vandermonde = np.vander(positions, polyorder + 1, increasing=True)
+            LossesPlotter._savgol_projections[key] = vandermonde @ np.linalg.pinv(vandermonde)
+        return LossesPlotter._savgol_projections[key]
+
+    @staticmethod
+    def _savgol_filter(values, window_length, polyorder):
+        # Smooth the values along their last axis
+
+        values = np.asarray(values)
+        if values.dtype != np.float32 and values.dtype != np.float64:
+            values = values.astype(np.float64)
+        projection = LossesPlotter._get_savgol_projection(window_length, polyorder).astype(values.dtype, copy=False)
+        half_window_length = window_length // 2
+
+        smoothed_values = correlate1d(values, projection[half_window_length], axis=-1, mode='constant')
+        smoothed_values[..., :half_window_length] = values[..., :window_length] @ projection[:half_window_length].T
+        smoothed_values[..., values.shape[-1] - half_window_length:] = \
+            values[..., -window_length:] @ projection[half_window_length + 1:].T
+
+        return smoothed_values
+
+    @staticmethod
+    def _configure_ax(ax, title=None, xlabel=None, ylabel=None,
         legend=False):
         ax.minorticks_off()
         ax.grid(linestyle='--')
@@ -291,15 +320,22 @@ class LossesPlotter(object):
         ax.margins(x=0)
         return ax
 
-    def _plot_fill_between(self, ax, color, values, label, linewidth=2):
+    @staticmethod
+    def _plot_fill_between(ax, color, values, label, linewidth=2, t=None):
         linecolor = color # TODO: compute a darker linecolor than facecolor
         facecolor = color
-        mu = np.mean(values, axis=1)
-        sigma = np.std(values, axis=1)
-        t = np.arange(len(values))
+        # Accumulate in double precision, as the spread within an epoch can be tiny compared
+        # to the values themselves and the difference would cancel out in single precision
+        mu = values.mean(axis=1, dtype=np.float64)
+        sigma = np.sqrt(np.square(values - mu[:, np.newaxis]).mean(axis=1))
+        if t is None:
+            t = np.arange(values.shape[0])
         ax.plot(t, mu, linewidth=linewidth, label=label, c=linecolor)
-        ax.fill_between(t, mu+sigma, mu-sigma, facecolor=facecolor, alpha=0.5)
+        ax.fill_between(t, mu+sigma, mu-sigma, facecolor=facecolor, alpha=0.5, rasterized=True)
         return ax
 
     def _get_colors_from_cmap(self, colormap_name, n_colors):
-        return [plt.get_cmap(colormap_name)(1. * i/n_colors) for i in range(n_colors)]
+        if colormap_name not in LossesPlotter._colormaps:
+            LossesPlotter._colormaps[colormap_name] = matplotlib.colormaps[colormap_name]
+        cmap = LossesPlotter._colormaps[colormap_name]
+        return cmap(np.arange(n_colors) / n_colors)
@@ -120,7 +120,8 @@ class CheckpointUtils(object):
         ConsoleLogger.status("Loading the configuration file '{}'".format(configuration_path))
         configuration = None
         with open(configuration_path, 'r') as file:
-            configuration = yaml.load(file, Loader=yaml.FullLoader)
+            # Use the libyaml parser if available
+            configuration = yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
         
         # Load the device configuration from the configuration state
         device_configuration = DeviceConfiguration.load_from_configuration(configuration)
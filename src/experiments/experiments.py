@@ -37,12 +37,14 @@ import numpy as np
 import random
 import pickle
 import os
+import gc
 
 
 class Experiments(object):
 
-    def __init__(self, experiments):
+    def __init__(self, experiments, deterministic=False):
         self._experiments = experiments
+        self._deterministic = deterministic
 
     @property
     def experiments(self):
@@ -50,21 +52,23 @@ class Experiments(object):
 
     def train(self):
         for experiment in self._experiments:
-            Experiments.set_deterministic_on(experiment.seed)
+            Experiments.set_seeds(experiment.seed, deterministic=self._deterministic)
             experiment.train()
-            torch.cuda.empty_cache()
+            # Free the unreachable tensors of this run without releasing the cached
+            # CUDA blocks, so that the next experiment reuses them instead of reallocating
+            gc.collect()
 
     def evaluate(self, evaluation_options):
         # TODO: put all types of evaluation in evaluation_options, and skip this loop if none of them are set to true
         for experiment in self._experiments:
-            Experiments.set_deterministic_on(experiment.seed)
+            Experiments.set_seeds(experiment.seed, deterministic=self._deterministic)
             experiment.evaluate(evaluation_options)
-            torch.cuda.empty_cache()
+            gc.collect()
 
         if type(self._experiments[0].seed) == list:
-            Experiments.set_deterministic_on(self._experiments[0].seed[0]) # For now use only the first seed there
+            Experiments.set_seeds(self._experiments[0].seed[0], deterministic=self._deterministic) # For now use only the first seed there
         else:
-            Experiments.set_deterministic_on(self._experiments[0].seed)
+            Experiments.set_seeds(self._experiments[0].seed, deterministic=self._deterministic)
 
         if evaluation_options['compute_quantized_embedding_spaces_animation']:
             EmbeddingSpaceStats.compute_quantized_embedding_spaces_animation(
@@ -116,12 +120,17 @@ class Experiments(object):
                 )
 
     @staticmethod
-    def set_deterministic_on(seed):
+    def set_seeds(seed, deterministic=False):
         torch.manual_seed(seed)
         torch.cuda.manual_seed(seed)
         np.random.seed(seed)
         random.seed(seed)
-        torch.backends.cudnn.deterministic = True
+        # The seeds are enough to reproduce the runs up to cuDNN nondeterminism. Unless
+        # strict reproducibility is asked (with "deterministic": true in the experiments file), let
+        # cuDNN benchmark and pick the fastest convolution algorithms instead of forcing its
+        # slower deterministic ones, since the input shapes are fixed
+        torch.backends.cudnn.deterministic = deterministic
+        torch.backends.cudnn.benchmark = not deterministic
 
     @staticmethod
     def load(experiments_path):
@@ -131,7 +140,8 @@ class Experiments(object):
 
             configuration = None
             with open(experiment_configurations['configuration_path'], 'r') as configuration_file:
-                configuration = yaml.load(configuration_file, Loader=yaml.FullLoader)
+                # Use the libyaml parser if available
+                configuration = yaml.load(configuration_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 
             if type(experiment_configurations['seed']) == list:
                 for seed in experiment_configurations['seed']:
@@ -157,4 +167,4 @@ class Experiments(object):
                     )
                     experiments.append(experiment)
 
-        return Experiments(experiments)
+        return Experiments(experiments, deterministic=experiment_configurations.get('deterministic', False))
@@ -0,0 +1,73 @@
+ #####################################################################################
+ # MIT License                                                                       #
+ #                                                                                   #
+ # Copyright (C) 2019 Charly Lamothe                                                 #
+ #                                                                                   #
+ # This file is part of VQ-VAE-Speech.                                               #
+ #                                                                                   #
+ #   Permission is hereby granted, free of charge, to any person obtaining a copy    #
+ #   of this software and associated documentation files (the "Software"), to deal   #
+ #   in the Software without restriction, including without limitation the rights    #
+ #   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell       #
+ #   copies of the Software, and to permit persons to whom the Software is           #
+ #   furnished to do so, subject to the following conditions:                        #
+ #                                                                                   #
+ #   The above copyright notice and this permission notice shall be included in all  #
+ #   copies or substantial portions of the Software.                                 #
+ #                                                                                   #
+ #   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR      #
+ #   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,        #
+ #   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE     #
+ #   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER          #
+ #   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,   #
+ #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE   #
+ #   SOFTWARE.                                                                       #
+ #####################################################################################
+import os
+import sys
+sys.path.append('..' + os.sep + '..' + os.sep + 'src')
+
+from evaluation.losses_plotter import LossesPlotter
+
+import unittest
+import numpy as np
+from scipy.signal import savgol_filter
+
+
+class SavgolFilterTest(unittest.TestCase):
+
+    def test_polynomials_are_preserved(self):
+        window_length = LossesPlotter._maximum_smoothing_window_length
+        polyorder = LossesPlotter._smoothing_polyorder
+        t = np.linspace(-1, 1, 1000)
+        for degree in range(polyorder + 1):
+            values = t ** degree
+            smoothed_values = LossesPlotter._savgol_filter(values, window_length, polyorder)
+            # The edges are fitted too, so the whole curve must come back unchanged
+            np.testing.assert_allclose(smoothed_values, values, atol=1e-8)
+
+    def test_agrees_with_scipy_interp_mode(self):
+        window_length = 49
+        polyorder = LossesPlotter._smoothing_polyorder
+        values = np.random.RandomState(0).randn(500)
+        np.testing.assert_allclose(
+            LossesPlotter._savgol_filter(values, window_length, polyorder),
+            savgol_filter(values, window_length, polyorder, mode='interp'),
+            atol=1e-8
+        )
+
+    def test_batch_matches_rows(self):
+        window_length = 49
+        polyorder = LossesPlotter._smoothing_polyorder
+        values = np.random.RandomState(0).randn(4, 500)
+        smoothed_values = LossesPlotter._savgol_filter(values, window_length, polyorder)
+        for i in range(len(values)):
+            np.testing.assert_allclose(
+                smoothed_values[i],
+                LossesPlotter._savgol_filter(values[i], window_length, polyorder),
+                atol=1e-12
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()